@@ -6,6 +6,7 @@ from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
 import json
+import random
 import traceback
 import time
 import uuid
@@ -14,6 +15,7 @@ from ansible.module_utils.basic import missing_required_lib
 try:
     import requests
     import requests.exceptions
+    from requests.adapters import HTTPAdapter
     HAS_REQUESTS = True
 except ImportError:
     HAS_REQUESTS = False
@@ -21,9 +23,26 @@ except ImportError:
 
 length = 250
 
+# HTTP connection pool sizing for the shared session
+pool_connections = 4
+pool_maxsize = 8
+
+# Time in seconds list responses are served from the client cache
+list_cache_ttl = 30
+
+# Task polling backoff, in seconds
+task_poll_initial_delay = 0.3
+task_poll_max_delay = 10.0
+task_poll_backoff_factor = 1.5
+task_poll_timeout = 3600
+# Server side wait requested per task GET, falls back to backoff if unsupported
+task_long_poll_wait = 10
+
 
 class NutanixApiError(Exception):
-    pass
+    def __init__(self, msg, status_code=None):
+        super(NutanixApiError, self).__init__(msg)
+        self.status_code = status_code
 
 
 class NutanixApiClient(object):
@@ -39,30 +58,72 @@ class NutanixApiClient(object):
         self.api_base = "https://{0}:{1}/api/nutanix".format(
             pc_hostname, pc_port)
         self.auth = (pc_username, pc_password)
+        # In-memory cache of idempotent list call responses
+        self.cache = {}
         # Ensure that all deps are present
         self.check_dependencies()
-        # Create session
+        # Create session, connections are kept alive and reused across calls
         self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.verify = self.validate_certs
+        self.session.headers.update({'Content-Type': 'application/json',
+                                     'Accept': 'application/json',
+                                     'Connection': 'keep-alive'})
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         if not self.validate_certs:
             from urllib3.exceptions import InsecureRequestWarning
             requests.packages.urllib3.disable_warnings(
                 category=InsecureRequestWarning)
 
-    def request(self, api_endpoint, method, data, timeout=20):
-        self.api_url = "{0}/{1}".format(self.api_base, api_endpoint)
-        headers = {'Content-Type': 'application/json',
-                   'Accept': 'application/json'}
+    def request(self, api_endpoint, method, data, timeout=20, cache=False, fail_on_error=True):
+        """
+        Send request to the api endpoint
+        Responses of cacheable (idempotent list) calls are reused for list_cache_ttl
+        seconds, any other non GET call invalidates the cache
+        Errors fail the module, or raise NutanixApiError if fail_on_error is False
+        (fail_json must only be called once, from the main thread)
+        """
+        if cache:
+            cached = self.cache.get((api_endpoint, method, data))
+            if cached and time.time() - cached[0] < list_cache_ttl:
+                return cached[1]
+        elif method != "GET":
+            self.cache.clear()
+
+        api_url = "{0}/{1}".format(self.api_base, api_endpoint)
         try:
-            response = self.session.request(method=method, url=self.api_url, auth=self.auth,
-                                            data=data, headers=headers, verify=self.validate_certs, timeout=timeout)
+            response = self.session.request(method=method, url=api_url,
+                                            data=data, timeout=timeout)
         except requests.exceptions.RequestException as cerr:
-            self.module.fail_json("Request failed {0}".format(str(cerr)))
-
-        if response.ok:
-            return response
+            error = NutanixApiError("Request failed {0}".format(str(cerr)))
         else:
-            self.module.fail_json("Request failed to complete, response code {0}, content {1}".format(
-                response.status_code, response.content))
+            if response.ok:
+                if cache:
+                    self.cache[(api_endpoint, method, data)] = (time.time(), response)
+                return response
+            error = NutanixApiError("Request failed to complete, response code {0}, content {1}".format(
+                response.status_code, response.content), response.status_code)
+
+        if fail_on_error:
+            self.module.fail_json(str(error))
+        raise error
+
+    def long_poll(self, api_endpoint, wait):
+        """
+        GET the api endpoint asking the server to wait up to given seconds for a change
+        Returns None instead of failing the module if the request is not accepted
+        """
+        api_url = "{0}/{1}".format(self.api_base, api_endpoint)
+        try:
+            response = self.session.get(url=api_url, params={"timeout_seconds": wait},
+                                        timeout=wait + 20)
+        except requests.exceptions.RequestException:
+            return None
+
+        return response if response.ok else None
 
     def check_dependencies(self):
         if not HAS_REQUESTS:
@@ -71,38 +132,68 @@ class NutanixApiClient(object):
                 exception=REQUESTS_IMPORT_ERROR)
 
 
-def task_poll(task_uuid, client):
+def task_poll(task_uuid, client, timeout=task_poll_timeout, fail_on_error=True):
     """
     This routine helps to poll given task and check if task is SUCCEEDED or FAILED
+    Task is long polled with a server side wait first, if the server does not hold
+    the request it falls back to polling with exponential backoff and jitter
     Args:
         task_uuid(str): task uuid
         client(obj): Rest client obj
+        timeout(int): max time in seconds to wait for the task
+        fail_on_error(bool): fail the module on request error, else raise NutanixApiError
     Returns:
         Returns None in-case of SUCCESS else error_output incase of FAILURE
     """
+    delay = task_poll_initial_delay
+    deadline = time.time() + timeout
+    long_poll = True
     while True:
-        response = client.request(
-            api_endpoint="v3/tasks/{0}".format(task_uuid), method="GET", data=None)
-        if response.json()["status"] == "SUCCEEDED":
+        response = None
+        held = False
+        if long_poll:
+            started = time.time()
+            response = client.long_poll(
+                "v3/tasks/{0}".format(task_uuid), task_long_poll_wait)
+            elapsed = time.time() - started
+            # Only a response held for the full wait may skip the client side sleep
+            held = response is not None and elapsed >= task_long_poll_wait
+            # Server rejected or ignored the wait, use client side backoff from now on
+            if response is None or elapsed < task_long_poll_wait / 2.0:
+                long_poll = False
+        if response is None:
+            response = client.request(
+                api_endpoint="v3/tasks/{0}".format(task_uuid), method="GET", data=None,
+                fail_on_error=fail_on_error)
+        task = response.json()
+        if task["status"] == "SUCCEEDED":
             return None
-        elif response.json()["status"] == "FAILED":
-            error_out = response.json()["error_detail"]
-            return error_out
-        time.sleep(10)
+        elif task["status"] == "FAILED":
+            return task["error_detail"]
+        if held:
+            if time.time() > deadline:
+                return "Timed out waiting for task {0} to complete".format(task_uuid)
+            continue
+        if time.time() + delay > deadline:
+            return "Timed out waiting for task {0} to complete".format(task_uuid)
+        time.sleep(delay + random.uniform(0, delay * 0.1))
+        delay = min(delay * task_poll_backoff_factor, task_poll_max_delay)
 
 
-def list_entities(api, filter, client):
+def list_entities(api, filter, client, fail_on_error=True):
     """
     This routine helps to list entities of a given api resource name and filter
     Args:
         api(str): api resource name
         filter(dict): filter payload
         client(obj): Rest client obj
+        fail_on_error(bool): fail the module on error, else raise NutanixApiError
     Returns:
         response.json()(dict): json object response
     """
     response = client.request(
-        api_endpoint="v3/{0}/list".format(api), method="POST", data=json.dumps(filter))
+        api_endpoint="v3/{0}/list".format(api), method="POST", data=json.dumps(filter),
+        cache=True, fail_on_error=fail_on_error)
     return response.json()
 
 
@@ -268,12 +359,13 @@ def get_image(image_uuid, client):
     return get_image.json()
 
 
-def create_image(data, client):
+def create_image(data, client, fail_on_error=True):
     """
     This routine helps to create image
     Args:
         data(dict): image payload data
         client(obj): Rest client obj
+        fail_on_error(bool): fail the module on error, else raise NutanixApiError
     Returns:
         task_uuid(str): task uuid
         image_uuid(str): image uuid
@@ -281,7 +373,8 @@ def create_image(data, client):
     response = client.request(
         api_endpoint="v3/images",
         method="POST",
-        data=json.dumps(data)
+        data=json.dumps(data),
+        fail_on_error=fail_on_error
     )
     json_content = response.json()
     return (
@@ -305,17 +398,19 @@ def update_image(image_uuid, data, client):
     return response.json()["status"]["execution_context"]["task_uuid"]
 
 
-def delete_image(image_uuid, client):
+def delete_image(image_uuid, client, fail_on_error=True):
     """
     This routine helps to delete image
     Args:
         image_uuid(str): image uuid
         client(obj): Rest client obj
+        fail_on_error(bool): fail the module on error, else raise NutanixApiError
     Returns:
         task_uuid(str): task uuid
     """
     response = client.request(
-        api_endpoint="v3/images/{0}".format(image_uuid), method="DELETE", data=None)
+        api_endpoint="v3/images/{0}".format(image_uuid), method="DELETE", data=None,
+        fail_on_error=fail_on_error)
     return response.json()["status"]["execution_context"]["task_uuid"]
 
 
@@ -381,7 +476,7 @@ def groups_call(filter, client):
         groups_response.json()(dict): json response
     """
     groups_response = client.request(
-        api_endpoint="v3/groups", method="POST", data=json.dumps(filter))
+        api_endpoint="v3/groups", method="POST", data=json.dumps(filter), cache=True)
     return groups_response.json()
 
 
@@ -52,6 +52,7 @@ options:
     image_url:
         description:
         - Image url
+        - The image is downloaded by PC directly from this url, not by the module
         type: str
     vm_disk:
         description:
@@ -90,8 +91,17 @@ options:
         description:
         - List of cluster names for image placement under these clusters
         - Image is placed directly on all clusters by default
+        - Cluster name to uuid map is cached in C(~/.ansible/tmp/nutanix_cluster_cache_<key>.json),
+          keyed by C(pc_hostname), C(pc_port) and C(pc_username), see C(cluster_cache_ttl)
+        - The cache is refreshed when a cluster is missing from it and removed when image creation fails
         type: list
         elements: str
+    cluster_cache_ttl:
+        description:
+        - Time in seconds the cached cluster name to uuid map is used for
+        - Set value to C(0) to always fetch clusters from PC
+        type: int
+        default: 300
     data:
         description:
         - Filter payload
@@ -182,12 +192,18 @@ RETURN = r"""
 ## TO-DO
 """
 
+import hashlib
 import json
+import os
+import time
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import splitext
 from urllib.parse import urlparse
 from ansible.module_utils.basic import AnsibleModule, env_fallback
 from ansible_collections.nutanix.nutanix.plugins.module_utils.nutanix_api_client import (
     NutanixApiClient,
+    NutanixApiError,
     create_image,
     update_image,
     list_entities,
@@ -196,44 +212,150 @@ from ansible_collections.nutanix.nutanix.plugins.module_utils.nutanix_api_client
     task_poll)
 
 
-CREATE_PAYLOAD = """{
-  "spec": {
-    "name": "IMAGE_NAME",
-    "resources": {
-      "image_type": "IMAGE_TYPE",
-      "initial_placement_ref_list": [],
-      "source_options": {
-        "allow_insecure_connection": true
-      }
+CREATE_PAYLOAD = {
+    "spec": {
+        "name": "IMAGE_NAME",
+        "resources": {
+            "image_type": "IMAGE_TYPE",
+            "initial_placement_ref_list": [],
+            "source_options": {
+                "allow_insecure_connection": True
+            }
+        },
+        "description": ""
     },
-    "description": ""
-  },
-  "api_version": "3.1.0",
-  "metadata": {
-    "kind": "image",
-    "name": "IMAGE_NAME"
-  }
-}"""
+    "api_version": "3.1.0",
+    "metadata": {
+        "kind": "image",
+        "name": "IMAGE_NAME"
+    }
+}
+
+# Characters with a special meaning in FIQL filters
+FIQL_RESERVED_CHARS = (",", ";", "(", ")")
+
+# Image type auto detected from image url extension
+IMAGE_TYPE_BY_EXTENSION = {
+    ".iso": "ISO_IMAGE",
+    ".qcow2": "DISK_IMAGE",
+    ".img": "DISK_IMAGE",
+    ".raw": "DISK_IMAGE"
+}
+
+# Cluster name to uuid map is cached on disk per PC host
+CLUSTER_CACHE_FILE = "~/.ansible/tmp/nutanix_cluster_cache_{0}.json"
 
 
 def set_list_payload(data):
     """
     Generate payload for pagination support
-    * FIQL filters are not supported in images and clusters API
-    * filter option is only meant for by vm list API(for getting VM UUID,
-      used in image creation from VM Disk)
+    * FIQL filters are not supported in clusters API
+    * filter option is used by images list API(for looking up images by name)
+      and vm list API(for getting VM UUID, used in image creation from VM Disk)
     """
-    payload = {}
+    return {key: data[key] for key in ("length", "offset", "filter") if data and key in data}
+
+
+def list_image_pages(payload, client, fail_on_error=True):
+    """Fetch all pages of an images list call"""
+    entities = []
+    payload = dict(payload)
+    payload["offset"] = payload.get("offset") or 0
+    while True:
+        image_list_data = list_entities('images', payload, client, fail_on_error)
+        entities.extend(image_list_data["entities"])
+        payload["offset"] += len(image_list_data["entities"])
+        if not image_list_data["entities"] or \
+                payload["offset"] >= image_list_data["metadata"]["total_matches"]:
+            break
+
+    return entities
 
-    if data:
-        if "length" in data:
-            payload["length"] = data["length"]
-        if "offset" in data:
-            payload["offset"] = data["offset"]
-        if "filter" in data:
-            payload["filter"] = data["filter"]
 
-    return payload
+def list_images_by_name(image_name, list_payload, client, fail_on_error=True):
+    """
+    List all images of a given name
+    Images are filtered server side, unless the name has FIQL reserved characters
+    or PC rejects the filter, in which case all images are scanned
+    """
+    payload = dict(list_payload)
+    payload.pop("filter", None)
+    entities = None
+
+    if not any(char in image_name for char in FIQL_RESERVED_CHARS):
+        filter_payload = dict(payload)
+        filter_payload["filter"] = "name=={0}".format(image_name)
+        try:
+            entities = list_image_pages(filter_payload, client, False)
+        except NutanixApiError as err:
+            if not (err.status_code and 400 <= err.status_code < 500):
+                if fail_on_error:
+                    client.module.fail_json(str(err))
+                raise
+    if entities is None:
+        entities = list_image_pages(payload, client, fail_on_error)
+
+    return {"entities": [entity for entity in entities if entity["status"]["name"] == image_name]}
+
+
+def get_cluster_cache_file(module):
+    """Get path of the cluster cache file for the PC host, port and user"""
+    params = module.params
+    cache_key = hashlib.sha1("{0}:{1}:{2}".format(
+        params["pc_hostname"], params["pc_port"], params["pc_username"]).encode("utf-8")).hexdigest()
+    return os.path.expanduser(CLUSTER_CACHE_FILE.format(cache_key))
+
+
+def invalidate_cluster_cache(module):
+    """Remove the cluster cache file"""
+    try:
+        os.remove(get_cluster_cache_file(module))
+    except OSError:
+        pass
+
+
+def get_cluster_uuid_map(module, client, list_payload, fail_on_error=True):
+    """
+    Get a map of cluster name : cluster uuid
+    The map is served from a local cache file while it is younger than
+    cluster_cache_ttl and knows all requested clusters, else it is refreshed
+    """
+    params = module.params
+    clusters = params.get("clusters") or []
+    cache_file = get_cluster_cache_file(module)
+
+    try:
+        if time.time() - os.path.getmtime(cache_file) < params["cluster_cache_ttl"]:
+            with open(cache_file, "r") as f:
+                cluster_uuid_map = json.load(f)
+            if all(cluster_name in cluster_uuid_map for cluster_name in clusters):
+                return cluster_uuid_map
+    except (OSError, ValueError):
+        pass
+
+    cluster_data = list_entities(
+        'clusters', list_payload, client, fail_on_error)
+    cluster_uuid_map = {entity["status"]["name"]: entity["metadata"]["uuid"]
+                        for entity in cluster_data["entities"]}
+
+    if params["cluster_cache_ttl"] <= 0:
+        return cluster_uuid_map
+
+    tmp_file = "{0}.{1}".format(cache_file, os.getpid())
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_file, "w") as f:
+            json.dump(cluster_uuid_map, f)
+        os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError):
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+    return cluster_uuid_map
 
 
 def generate_argument_spec(result):
@@ -261,6 +383,7 @@ def generate_argument_spec(result):
             )
         ),
         clusters=dict(type="list", elements="str"),
+        cluster_cache_ttl=dict(type="int", default=300),
         data=dict(
             type="dict",
             default={"offset": 0, "length": 500},
@@ -289,67 +412,97 @@ def generate_argument_spec(result):
     return module
 
 
-def get_existing_image_state(module, client):
+def list_image_entities(module, client, list_payload):
+    """
+    Fetch image list, cluster map and vm list required for image creation
+    The list calls are independent, so they are issued concurrently
+    Workers raise errors, which are reported once from the main thread
+    """
+    params = module.params
+    futures, entities, errors = {}, {}, []
+    clusters = params.get("clusters")
+    vm_disk = params.get("vm_disk")
+    vm_disk_uuid = params.get("vm_disk_uuid")
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures["images"] = executor.submit(
+            list_images_by_name, params.get("image_name"), list_payload, client, False)
+        if clusters:
+            futures["clusters"] = executor.submit(
+                get_cluster_uuid_map, module, client, list_payload, False)
+        if vm_disk and not vm_disk_uuid:
+            vm_list_payload = dict(list_payload)
+            vm_list_payload["filter"] = "vm_name=={0}".format(vm_disk)
+            futures["vms"] = executor.submit(
+                list_entities, 'vms', vm_list_payload, client, False)
+
+        for api, future in futures.items():
+            try:
+                entities[api] = future.result()
+            except NutanixApiError as err:
+                if str(err) not in errors:
+                    errors.append(str(err))
+
+    if errors:
+        module.fail_json("; ".join(errors))
+
+    return entities
+
+
+def get_existing_image_state(module, image_list_data):
     """Check if an image is present in PC"""
+    params = module.params
     image_state = {"match_state": False, "match_name": False,
                    "match_type": False, "match_description": False}
     image_uuid = None
-    image_name = module.params.get("image_name")
-    image_type = module.params.get("image_type")
-    image_description = module.params.get("image_description")
-    image_url = module.params.get("image_url")
-    payload = set_list_payload(module.params["data"])
-    image_list_data = list_entities('images', payload, client)
+    image_name = params.get("image_name")
+    image_type = params.get("image_type")
+    image_description = params.get("image_description")
+    images_by_name = {}
     for entity in image_list_data["entities"]:
-        if image_name == entity["status"]["name"]:
-            existing_image_type = entity["status"]["resources"]["image_type"]
-            existing_image_description = entity["status"].get("description")
-            image_state["match_name"] = True
-            image_uuid = entity["metadata"]["uuid"]
-            if image_type == existing_image_type and image_description == existing_image_description:
-                image_state["match_state"] = True
-                break
-            elif image_type == existing_image_type:
-                image_state["match_type"] = True
-                break
-            elif image_description == existing_image_description:
-                image_state["match_description"] = True
-                break
+        images_by_name.setdefault(entity["status"]["name"], entity)
+
+    entity = images_by_name.get(image_name)
+    if entity:
+        existing_image_type = entity["status"]["resources"]["image_type"]
+        existing_image_description = entity["status"].get("description")
+        image_state["match_name"] = True
+        image_uuid = entity["metadata"]["uuid"]
+        if image_type == existing_image_type and image_description == existing_image_description:
+            image_state["match_state"] = True
+        elif image_type == existing_image_type:
+            image_state["match_type"] = True
+        elif image_description == existing_image_description:
+            image_state["match_description"] = True
 
     return image_state, image_uuid
 
 
-def create_image_spec(module, client, result):
+def create_image_spec(module, result, cluster_uuid_map=None, vm_list_data=None):
     """Generate spec for image creation"""
-    cluster_validated = False
+    params = module.params
     cluster_name_and_uuid = {}
-    image_name = module.params.get("image_name")
-    image_url = module.params.get("image_url")
-    vm_disk = module.params.get("vm_disk")
-    vm_disk_uuid = module.params.get("vm_disk_uuid")
-    image_type = module.params.get("image_type")
-    image_description = module.params.get("image_description")
-    image_checksum = module.params.get("image_checksum")
-    clusters = module.params.get("clusters")
-    create_payload = json.loads(CREATE_PAYLOAD)
-    vm_list_payload = set_list_payload(module.params["data"])
+    image_name = params.get("image_name")
+    image_url = params.get("image_url")
+    vm_disk = params.get("vm_disk")
+    vm_disk_uuid = params.get("vm_disk_uuid")
+    image_type = params.get("image_type")
+    image_description = params.get("image_description")
+    image_checksum = params.get("image_checksum")
+    clusters = params.get("clusters")
+    create_payload = deepcopy(CREATE_PAYLOAD)
 
     # Auto detect image_type based on url extension
     if not image_type:
         parsed_url = urlparse(image_url)
         path, extension = splitext(parsed_url.path)
-        if extension == ".iso":
-            image_type = "ISO_IMAGE"
-        elif extension == ".qcow2":
-            image_type = "DISK_IMAGE"
-        else:
+        image_type = IMAGE_TYPE_BY_EXTENSION.get(extension.lower())
+        if not image_type:
             module.fail_json(
                 "Unable to identify image_type, specify the value manually")
 
     # Get VM UUID for image creation from VM Disk and update spec
     if vm_disk and not vm_disk_uuid:
-        vm_list_payload["filter"] = "vm_name=={0}".format(vm_disk)
-        vm_list_data = list_entities('vms', vm_list_payload, client)
         # vm_name is considered to be unique
         # To-do: check and validate vm_disk_uuid for VMs with multiple Disks
         vm_disk_uuid = vm_list_data["entities"][0]["status"]["resources"]["disk_list"][0]["uuid"]
@@ -368,20 +521,15 @@ def create_image_spec(module, client, result):
 
     # Get cluster UUID
     if clusters:
-        cluster_payload = set_list_payload(module.params.get("data"))
-        cluster_data = list_entities('clusters', cluster_payload, client)
-        for cluster_name in clusters:
-            for entity in cluster_data["entities"]:
-                if entity["status"]["name"] == cluster_name:
-                    cluster_uuid = entity["metadata"]["uuid"]
-                    cluster_name_and_uuid[cluster_name] = cluster_uuid
-                    create_payload["spec"]["resources"]["initial_placement_ref_list"].append(
-                        {'kind': 'cluster', 'uuid': cluster_uuid})
-        if len(cluster_name_and_uuid) != len(clusters):
-            for cluster_name in cluster_name_and_uuid:
-                clusters.remove(cluster_name)
+        cluster_name_and_uuid = {cluster_name: cluster_uuid_map[cluster_name]
+                                 for cluster_name in clusters if cluster_name in cluster_uuid_map}
+        for cluster_uuid in cluster_name_and_uuid.values():
+            create_payload["spec"]["resources"]["initial_placement_ref_list"].append(
+                {'kind': 'cluster', 'uuid': cluster_uuid})
+        missing_clusters = set(clusters) - set(cluster_name_and_uuid)
+        if missing_clusters:
             module.fail_json(
-                "Could not find cluster(s) with name {0}".format(str(clusters)))
+                "Could not find cluster(s) with name {0}".format(sorted(missing_clusters)))
     else:
         del create_payload["spec"]["resources"]["initial_placement_ref_list"]
 
@@ -393,28 +541,32 @@ def create_image_spec(module, client, result):
     return create_payload
 
 
-def _create(module, client, result):
+def _create(module, client, result, list_payload):
     """Create image"""
-    image_count = 0
-    image_uuid_list = []
-    image_spec = create_image_spec(module, client, result)
-    image_name = module.params.get("image_name")
+    entities = list_image_entities(module, client, list_payload)
+    image_spec = create_image_spec(
+        module, result, entities.get("clusters"), entities.get("vms"))
 
     # Get existing image state
-    image_state, image_uuid = get_existing_image_state(module, client)
-    for state_name, state_value in image_state.items():
-        if state_name == "match_state" and state_value:
-            result["image_state"] = image_state
-            module.exit_json(**result)
-            return result
-        elif state_name != "match_state" and state_value:
-            return _update(module, client, result, image_uuid)
+    image_state, image_uuid = get_existing_image_state(module, entities["images"])
+    if image_state["match_state"]:
+        result["image_state"] = image_state
+        module.exit_json(**result)
+        return result
+    # Image with the same name exists but type and/or description differ
+    if image_state["match_name"]:
+        return _update(module, client, result, image_uuid)
 
     # Create Image
-    task_uuid, image_uuid = create_image(image_spec, client)
-
-    task_status = task_poll(task_uuid, client)
+    try:
+        task_uuid, image_uuid = create_image(image_spec, client, False)
+        task_status = task_poll(task_uuid, client, fail_on_error=False)
+    except NutanixApiError as err:
+        task_status = str(err)
     if task_status:
+        # Cached cluster uuids may be stale, refresh them on the next run
+        if module.params.get("clusters"):
+            invalidate_cluster_cache(module)
         result["failed"] = True
         result["msg"] = task_status
         return result
@@ -426,13 +578,10 @@ def _create(module, client, result):
 
 def _update(module, client, result, image_uuid):
     """Update Image"""
-    image_count = 0
-    data = set_list_payload(module.params["data"])
-    image_name = module.params.get("image_name")
-    image_type = module.params.get("image_type")
-    image_description = module.params.get("description")
-    image_uuid_for_update = module.params.get("image_uuid")
-    image_description = module.params.get("image_description")
+    params = module.params
+    image_type = params.get("image_type")
+    image_description = params.get("image_description")
+    image_uuid_for_update = params.get("image_uuid")
     if image_uuid_for_update:
         image_uuid = image_uuid_for_update
     # Get image spec
@@ -444,7 +593,6 @@ def _update(module, client, result, image_uuid):
     if image_description:
         image_spec["spec"]["description"] = image_description
     else:
-        image_uuid = image_spec["metadata"]["uuid"]
         # Add empty description
         # This will clear existing description if playbook doesn't have image_description field
         image_spec["spec"]["description"] = ""
@@ -463,55 +611,63 @@ def _update(module, client, result, image_uuid):
     return result
 
 
-def _delete(module, client, result):
+def _delete(module, client, result, list_payload):
     """Delete image(s)"""
-    image_count = 0
-    task_uuid_list, image_list, image_uuid_list = [], [], []
-    data = set_list_payload(module.params["data"])
     image_name = module.params.get("image_name")
 
-    if image_name:
-        image_list_data = list_entities('images', data, client)
-        for entity in image_list_data["entities"]:
-            if image_name == entity["status"]["name"]:
-                image_uuid = entity["metadata"]["uuid"]
-                image_uuid_list.append(image_uuid)
-                image_update_spec = entity
-                image_count += 1
-            if image_count > 1:
-                result["msg"] = "Found multiple images with name {0}".format(
-                    image_name)
-                result["failed"] = True
-                return result
-        if image_count == 0:
-            return result
-        if not image_uuid_list:
-            return result
-        elif image_count == 1:
-            result["image_count"] = 1
-            result["changed"] = True
-            task_uuid = delete_image(image_uuid, client)
-            # Check task status for removal of a single image
-            if task_uuid:
-                task_status = task_poll(task_uuid, client)
-                if task_status:
-                    result["failed"] = True
-                    result["msg"] = task_status
-                    return result
-    else:
+    if not image_name:
         result["failed"] = True
         return result
 
-    # Check status of all deletion tasks for removal of multiple images with duplicate names
-    if task_uuid_list:
-        result["msg"] = []
-        for tuuid in task_uuid_list:
-            task_status = task_poll(tuuid, client)
-            if task_status:
-                result["failed"] = True
-                result["msg"].append(task_status)
+    # Image list is already filtered by name server side
+    image_list_data = list_images_by_name(image_name, list_payload, client)
+    image_uuid_list = [entity["metadata"]["uuid"] for entity in image_list_data["entities"]
+                       if image_name == entity["status"]["name"]]
+    image_count = len(image_uuid_list)
+    if not image_count:
         return result
 
+    result["image_count"] = image_count
+    deleted_image_uuids, failed_image_uuids, task_errors = [], [], []
+
+    # Delete all images with the given name and poll the deletion tasks concurrently
+    # Workers raise errors, which are collected per image in the main thread
+    with ThreadPoolExecutor(max_workers=min(8, image_count)) as executor:
+        delete_futures = {executor.submit(delete_image, image_uuid, client, False): image_uuid
+                          for image_uuid in image_uuid_list}
+        poll_futures = {}
+        for future in as_completed(delete_futures):
+            image_uuid = delete_futures[future]
+            try:
+                task_uuid = future.result()
+            except NutanixApiError as err:
+                failed_image_uuids.append(image_uuid)
+                task_errors.append(str(err))
+                continue
+            if task_uuid:
+                poll_futures[executor.submit(task_poll, task_uuid, client, fail_on_error=False)] = image_uuid
+            else:
+                deleted_image_uuids.append(image_uuid)
+
+        for future in as_completed(poll_futures):
+            image_uuid = poll_futures[future]
+            try:
+                task_status = future.result()
+            except NutanixApiError as err:
+                task_status = str(err)
+            if task_status:
+                failed_image_uuids.append(image_uuid)
+                task_errors.append(task_status)
+            else:
+                deleted_image_uuids.append(image_uuid)
+
+    result["deleted_image_uuids"] = deleted_image_uuids
+    result["changed"] = bool(deleted_image_uuids)
+    if task_errors:
+        result["failed"] = True
+        result["failed_image_uuids"] = failed_image_uuids
+        result["msg"] = task_errors[0] if image_count == 1 else task_errors
+
     return result
 
 
@@ -528,10 +684,12 @@ def main():
 
     # Create api client
     api_client = NutanixApiClient(arg_spec)
+    # List payload is shared by all list calls, callers copy it before changing it
+    list_payload = set_list_payload(arg_spec.params["data"])
     if arg_spec.params.get("state") == "present":
-        result = _create(arg_spec, api_client, result_init)
+        result = _create(arg_spec, api_client, result_init, list_payload)
     elif arg_spec.params.get("state") == "absent":
-        result = _delete(arg_spec, api_client, result_init)
+        result = _delete(arg_spec, api_client, result_init, list_payload)
 
     arg_spec.exit_json(**result)
 
@@ -104,17 +104,7 @@ from ansible_collections.nutanix.nutanix.plugins.module_utils.nutanix_api_client
 
 def set_list_payload(data):
     """Generate payload for pagination support"""
-    payload = {}
-
-    if data:
-        if "length" in data:
-            payload["length"] = data["length"]
-        if "offset" in data:
-            payload["offset"] = data["offset"]
-        if "filter" in data:
-            payload["filter"] = data["filter"]
-
-    return payload
+    return {key: data[key] for key in ("length", "offset", "filter") if data and key in data}
 
 
 def get_image_list():